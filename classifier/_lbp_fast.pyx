@@ -0,0 +1,62 @@
+# cython: boundscheck=False, wraparound=False, initializedcheck=False, cdivision=True
+import numpy as np
+
+from cython.parallel import prange
+from libc.math cimport floor
+
+
+def lbp_u8_hist(const unsigned char[:, ::1] img, const double[::1] dy,
+                const double[::1] dx, const long long[::1] lut, int n_bins, int radius):
+    '''
+    Histogram of uniform LBP codes over the interior pixels of a uint8 image
+    ------------------------------
+    Parameters
+    ----------
+    img : ndarray
+        2-D uint8 grey image
+
+    dy, dx : ndarray
+        offsets of the sampling points relative to the centre pixel
+
+    lut : ndarray
+        bin index for every LBP code
+
+    n_bins : int
+        number of histogram bins
+
+    radius : int
+        radius of the sampling circle
+    Returns
+    -------
+    ndarray
+        float32 histogram with n_bins bins
+    '''
+    cdef Py_ssize_t h = img.shape[0]
+    cdef Py_ssize_t w = img.shape[1]
+    cdef Py_ssize_t n_points = dy.shape[0]
+    cdef Py_ssize_t y, x, p, y0, x0
+    cdef int code
+    cdef double centre, sy, sx, fy, fx, top, bottom
+
+    # one histogram per row so that prange iterations never share a counter
+    rows = np.zeros((h, n_bins), dtype=np.int64)
+    cdef long long[:, ::1] rows_v = rows
+
+    for y in prange(radius, h - radius - 1, nogil=True, schedule='static'):
+        for x in range(radius, w - radius - 1):
+            centre = img[y, x]
+            code = 0
+            for p in range(n_points):
+                sy = y + dy[p]
+                sx = x + dx[p]
+                y0 = <Py_ssize_t>floor(sy)
+                x0 = <Py_ssize_t>floor(sx)
+                fy = sy - y0
+                fx = sx - x0
+                top = img[y0, x0] + fx * (img[y0, x0 + 1] - img[y0, x0])
+                bottom = img[y0 + 1, x0] + fx * (img[y0 + 1, x0 + 1] - img[y0 + 1, x0])
+                if top + fy * (bottom - top) >= centre:
+                    code = code | (1 << p)
+            rows_v[y, lut[code]] += 1
+
+    return rows.sum(axis=0).astype(np.float32)
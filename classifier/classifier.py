@@ -2,26 +2,92 @@ import os.path
 import time
 import warnings
 import math
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
-from glob import glob
-import pandas as pd
 import pickle
+try:
+    from hashlib import blake2b
+except ImportError:
+    from pyblake2 import blake2b
+import h5py
+import cv2
 import mahotas as mh
-from mahotas.features import lbp
 from mahotas.features import surf
 import numpy as np
+import pyximport
+from joblib import Parallel, delayed, cpu_count
 from sklearn import cross_validation
 from sklearn.cluster import MiniBatchKMeans
-from sklearn.linear_model import LogisticRegression
-from sklearn.pipeline import Pipeline
+from sklearn.linear_model import LogisticRegressionCV
 from sklearn.preprocessing import StandardScaler
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.grid_search import GridSearchCV
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+# the GPU path needs a CUDA device, not just the cupy package
+if cupy is not None:
+    try:
+        has_gpu = cupy.cuda.runtime.getDeviceCount() > 0
+    except cupy.cuda.runtime.CUDARuntimeError:
+        has_gpu = False
+    if has_gpu:
+        import gpu_features
+    else:
+        cupy = None
 
 warnings.filterwarnings("ignore", category=DeprecationWarning) 
 
 classes = ['c0', 'c1', 'c2', 'c3', 'c4', 'c5', 'c6', 'c7', 'c8', 'c9']
-    
+
+# LBP sampling circle, offsets are (dy, dx) relative to the centre pixel
+LBP_RADIUS = 8
+LBP_POINTS = 6
+_lbp_angles = 2 * np.pi * np.arange(LBP_POINTS) / LBP_POINTS
+LBP_DY = np.round(-LBP_RADIUS * np.sin(_lbp_angles), 10)
+LBP_DX = np.round(LBP_RADIUS * np.cos(_lbp_angles), 10)
+
+
+def _uniform_lbp_lut(points):
+    '''
+    Lookup table folding every LBP code into its rotation invariant uniform bin
+    ------------------------------
+    Parameters
+    ----------
+    points : int
+        number of sampling points
+    Returns
+    -------
+    ndarray
+        bin index for each of the 2**points codes, uniform codes map to their
+        number of set bits and the rest share bin points + 1
+    '''
+    lut = np.empty(2 ** points, dtype=np.int64)
+    for code in range(2 ** points):
+        bits = [(code >> p) & 1 for p in range(points)]
+        transitions = sum(bits[p] != bits[p - 1] for p in range(points))
+        lut[code] = sum(bits) if transitions <= 2 else points + 1
+    return lut
+
+
+LBP_LUT = _uniform_lbp_lut(LBP_POINTS)
+LBP_DIM = LBP_POINTS + 2
+
+# cooccurence matrices always span the full uint8 range so they can be stacked
+GLCM_LEVELS = 256
+# 13 haralick features for each of the 4 directions
+HARALICK_DIM = 4 * 13
+# images per haralick_batch call, keeps the float32 matrices around 64 MB
+HARALICK_BATCH = 64
+# images extracted between writes to the feature cache
+FEATURE_CACHE_CHUNK = 16 * HARALICK_BATCH
+# group of the feature cache holding the features of every image stacked in one array each
+MERGED_GROUP = 'merged'
+
 
 def compute_texture(fname):
     '''
@@ -36,9 +102,125 @@ def compute_texture(fname):
     ndarray
         1-D array of features
     '''
-    im = mh.colors.rgb2grey(mh.imread(fname))
-    im = im.astype(np.uint8)
-    return mh.features.haralick(im).ravel()
+    im = cv2.cvtColor(mh.imread(fname), cv2.COLOR_RGB2GRAY)
+    return compute_texture_from_array(im)
+
+
+def compute_texture_from_array(im_grey_u8):
+    '''
+    Compute haralick features for an already decoded image
+    ------------------------------
+    Parameters
+    ----------
+    im_grey_u8 : ndarray
+        2-D uint8 grey image
+    Returns
+    -------
+    ndarray
+        1-D array of features
+    '''
+    return mh.features.haralick(im_grey_u8).ravel()
+
+
+def _array_module(a):
+    '''
+    numpy, or cupy for arrays living on the GPU
+    '''
+    return cupy.get_array_module(a) if cupy is not None else np
+
+
+def _diagonal_sums(p):
+    '''
+    Sum every diagonal of the trailing two axes, offsets -(L-1) to L-1
+    '''
+    xp = _array_module(p)
+    size = p.shape[-1]
+    return xp.stack([xp.diagonal(p, offset=k, axis1=-2, axis2=-1).sum(axis=-1)
+                     for k in range(1 - size, size)], axis=-1)
+
+
+def _entropy(p, axis):
+    '''
+    Base 2 entropy of p along axis, treating 0 * log(0) as 0
+    '''
+    xp = _array_module(p)
+    return -(p * xp.log2(xp.where(p > 0, p, 1))).sum(axis=axis)
+
+
+def haralick_batch(glcm_stack, levels=None):
+    '''
+    Compute the 13 haralick features for a stack of cooccurence matrices,
+    vectorized over images and directions. Matches mahotas.features.haralick
+    for symmetric matrices. Used on the GPU with cupy arrays, on the CPU
+    mahotas is faster per image.
+    ------------------------------
+    Parameters
+    ----------
+    glcm_stack : ndarray
+        (N, 4, L, L) cooccurence matrices
+
+    levels : ndarray
+        number of grey levels (max value + 1) of each image, only used by the
+        variance of the difference distribution. Defaults to L
+    Returns
+    -------
+    ndarray
+        (N, 4, 13) array of features
+    '''
+    xp = _array_module(glcm_stack)
+    size = glcm_stack.shape[-1]
+    if levels is None:
+        levels = xp.full(len(glcm_stack), size)
+    levels = xp.asarray(levels, dtype=xp.float64)[:, xp.newaxis]
+
+    i, j = xp.mgrid[:size, :size]
+    k = xp.arange(size, dtype=xp.float64)
+
+    total = glcm_stack.sum(axis=(-2, -1), dtype=xp.float64)
+    p = glcm_stack.astype(xp.float32)
+    p /= total[..., xp.newaxis, xp.newaxis].astype(xp.float32)
+
+    px = p.sum(axis=-2, dtype=xp.float64)
+    py = p.sum(axis=-1, dtype=xp.float64)
+    ux = px.dot(k)
+    uy = py.dot(k)
+    vx = px.dot(k ** 2) - ux ** 2
+    vy = py.dot(k ** 2) - uy ** 2
+    sx = xp.sqrt(vx)
+    sy = xp.sqrt(vy)
+
+    diagonals = _diagonal_sums(p).astype(xp.float64)
+    px_minus_y = diagonals[..., size - 1:].copy()
+    px_minus_y[..., 1:] += diagonals[..., size - 2::-1]
+    px_plus_y = _diagonal_sums(p[..., ::-1])[..., ::-1].astype(xp.float64)
+
+    feats = xp.empty(p.shape[:2] + (13,), dtype=xp.float64)
+    feats[..., 0] = xp.einsum('...ij,...ij->...', p, p)
+    feats[..., 1] = xp.einsum('...ij,ij->...', p, ((i - j) ** 2).astype(xp.float32))
+    cov = xp.einsum('...ij,ij->...', p, (i * j).astype(xp.float32)) - ux * uy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        feats[..., 2] = xp.where((sx == 0) | (sy == 0), 1., cov / (sx * sy))
+    feats[..., 3] = vx
+    feats[..., 4] = xp.einsum('...ij,ij->...', p, (1. / (1 + (i - j) ** 2)).astype(xp.float32))
+    feats[..., 5] = xp.einsum('...ij,ij->...', p, (i + j).astype(xp.float32))
+    feats[..., 6] = xp.einsum('...ij,ij->...', p, ((i + j) ** 2).astype(xp.float32)) - feats[..., 5] ** 2
+    feats[..., 7] = _entropy(px_plus_y, -1)
+    feats[..., 8] = _entropy(p, (-2, -1))
+    feats[..., 9] = (px_minus_y ** 2).sum(axis=-1) / levels - 1. / levels ** 2
+    feats[..., 10] = _entropy(px_minus_y, -1)
+
+    # px and py sum to one, so the entropy of their outer product is HX + HY and
+    # the cross entropy with p only needs the marginals (p is symmetric)
+    hx = _entropy(px, -1)
+    hy = _entropy(py, -1)
+    log_px = xp.log2(xp.where(px > 0, px, 1))
+    log_py = xp.log2(xp.where(py > 0, py, 1))
+    hxy1 = -((py * log_px).sum(axis=-1) + (px * log_py).sum(axis=-1))
+    hxy2 = hx + hy
+    hmax = xp.maximum(hx, hy)
+    feats[..., 11] = (feats[..., 8] - hxy1) / xp.where(hmax == 0, 1., hmax)
+    feats[..., 12] = xp.sqrt(xp.maximum(0, 1 - xp.exp(-2. * (hxy2 - feats[..., 8]))))
+    return feats
 
 
 def compute_lbp(fname):
@@ -55,11 +237,165 @@ def compute_lbp(fname):
         linear binary patterns
     '''
     imc = mh.imread(fname)
-    im = mh.colors.rgb2grey(imc)
-    return lbp(im, radius=8, points=6)
+    return compute_lbp_from_array(cv2.cvtColor(imc, cv2.COLOR_RGB2GRAY))
 
 
-def accuracy(featureType, features, labels, predict=False, test_features=[], test_images=[]):
+def compute_lbp_from_array(im_grey_u8):
+    '''
+    Compute linear binary patterns for an already decoded image
+    ------------------------------
+    Parameters
+    ----------
+    im_grey_u8 : ndarray
+        2-D uint8 grey image
+    Returns
+    -------
+    ndarray
+        histogram of uniform linear binary patterns, LBP_DIM bins
+    '''
+    # imported here, joblib workers unpickle functions from __main__ by value
+    # without running its module level pyximport.install()
+    pyximport.install()
+    from _lbp_fast import lbp_u8_hist
+    im = np.ascontiguousarray(im_grey_u8, dtype=np.uint8)
+    return lbp_u8_hist(im, LBP_DY, LBP_DX, LBP_LUT, LBP_DIM, LBP_RADIUS)
+
+
+def _extract_one(fname, label):
+    '''
+    Decode an image and extract its surf features
+    ------------------------------
+    Parameters
+    ----------
+    fname : str
+        filepath for image to process
+
+    label : str
+        class of the image, None for test images
+
+    Returns
+    -------
+    dict
+        grey image, surf descriptors and label (None for test images)
+    '''
+
+    # decode once and share the grey image between all feature types
+    imc = mh.imread(fname)
+    # straight to uint8, no float64 intermediate
+    grey_u8 = cv2.cvtColor(imc, cv2.COLOR_RGB2GRAY)
+
+    # dsize is (width, height), 600 rows by 450 columns as before
+    im = cv2.resize(grey_u8, (450, 600), interpolation=cv2.INTER_AREA)
+
+    return {
+        'grey': grey_u8,
+        # Dense sampling of surf
+        # regular surf: surf.surf(im, descriptor_only=True)
+        'surf': surf.dense(im, spacing=16),
+        'label': label,
+    }
+
+
+def _texture_batch(greys):
+    '''
+    Compute haralick and lbp features for a batch of grey images on the CPU
+    ------------------------------
+    Parameters
+    ----------
+    greys : list
+        2-D uint8 grey images
+
+    Returns
+    -------
+    haralicks : ndarray
+        (N, 52) haralick features
+
+    lbps : ndarray
+        (N, LBP_DIM) linear binary patterns
+    '''
+
+    haralicks = np.array([compute_texture_from_array(grey) for grey in greys], dtype=np.float32)
+    lbps = np.array([compute_lbp_from_array(grey) for grey in greys])
+    return haralicks, lbps
+
+
+def _texture_batch_gpu(greys):
+    '''
+    Compute haralick and lbp features for a batch of same sized grey images
+    on the GPU
+    ------------------------------
+    Parameters
+    ----------
+    greys : list
+        2-D uint8 grey images
+
+    Returns
+    -------
+    haralicks : ndarray
+        (N, 52) haralick features
+
+    lbps : ndarray
+        (N, LBP_DIM) linear binary patterns
+    '''
+
+    ims_u8 = cupy.asarray(np.stack(greys))
+    glcms = gpu_features.glcm_batch(ims_u8, GLCM_LEVELS)
+    levels = ims_u8.reshape(len(greys), -1).max(axis=1).astype(cupy.int64) + 1
+    haralicks = haralick_batch(glcms, levels).reshape(len(greys), -1).astype(cupy.float32)
+    lbps = gpu_features.lbp_batch(ims_u8, LBP_DY, LBP_DX, LBP_LUT, LBP_DIM, LBP_RADIUS)
+    return cupy.asnumpy(haralicks), cupy.asnumpy(lbps).astype(np.float32)
+
+
+def _extract_batch(images, keep_grey=False):
+    '''
+    Extract features for a batch of images
+    ------------------------------
+    Parameters
+    ----------
+    images : list
+        (filepath, label) tuples for images to process
+
+    keep_grey : Boolean
+        True to return the grey images instead of computing haralick and lbp
+        features, which are then computed on the GPU by the parent process
+
+    Returns
+    -------
+    list
+        one dict of haralick, lbp (or grey image), surf descriptors and label
+        per image
+    '''
+
+    results = [_extract_one(fname, label) for fname, label in images]
+    if not keep_grey:
+        haralicks, lbps = _texture_batch([res.pop('grey') for res in results])
+        for res, haralick, binary_patt in zip(results, haralicks, lbps):
+            res['haralick'] = haralick
+            res['lbp'] = binary_patt
+    return results
+
+
+def _add_texture_gpu(results):
+    '''
+    Replace the grey images of extracted results by their haralick and lbp
+    features, computed on the GPU in batches of HARALICK_BATCH images
+    ------------------------------
+    Parameters
+    ----------
+    results : list
+        dicts returned by _extract_batch with keep_grey=True
+    '''
+
+    for start in range(0, len(results), HARALICK_BATCH):
+        batch = results[start:start + HARALICK_BATCH]
+        haralicks, lbps = _texture_batch_gpu([res.pop('grey') for res in batch])
+        for res, haralick, binary_patt in zip(batch, haralicks, lbps):
+            res['haralick'] = haralick
+            res['lbp'] = binary_patt
+
+
+def accuracy(featureType, features, labels, predict=False, test_features=[], test_images=[], folds=None,
+             n_jobs=-1):
     ''' 
     Trains classifier, makes predictions and computes best score and parameters for classifier
     ------------------------------
@@ -69,7 +405,7 @@ def accuracy(featureType, features, labels, predict=False, test_features=[], tes
         feature set
 
     features : ndarray
-        1-D array of train features
+        1-D array of standardized train features
 
     labels : ndarray
         1-D array of labels
@@ -78,10 +414,18 @@ def accuracy(featureType, features, labels, predict=False, test_features=[], tes
         True to make predictions
 
     test_features : ndarray
-        1-D array of test features
+        1-D array of test features, standardized like the train features
 
-    test_images : ndarray
-        1-D array of image filepaths
+    test_images : list
+        (filepath, label) tuples of the test images
+
+    folds : list
+        (train, test) index pairs for cross validation, share them between
+        calls so every feature set is scored on the same splits
+
+    n_jobs : int
+        number of folds fitted in parallel, lower it when accuracy itself runs
+        in a worker process
 
     Returns
     -------
@@ -93,54 +437,66 @@ def accuracy(featureType, features, labels, predict=False, test_features=[], tes
 
     '''
 
-    param_grid_LR = {'C': [0.001, 0.01, 0.1, 1, 10, 100, 1000] }
-    cv = cross_validation.KFold(n=len(features), n_folds=10, shuffle=False,
-                               random_state=None)
-    log_r = LogisticRegression(solver="lbfgs", multi_class="multinomial")
-    CV_log = GridSearchCV(estimator=log_r, param_grid=param_grid_LR, cv=cv)
-
-    classifier = Pipeline([
-                  ('preproc', StandardScaler()),
-                  ('log',CV_log)
-                  ])
-
-    # Model One vs Rest with Random Forests
-    # param_grid_RF = { 
-    #     'n_estimators': [100, 700],
-    #     'max_features': ['auto', 'sqrt', 'log2']
-    # }
-    # classifier = [RandomForestClassifier(n_jobs=-1,n_estimators=100) for i in classes]
-    # CV_rfcs = [GridSearchCV(estimator=clf, param_grid=param_grid_RF, cv=cv) for clf in classifier]
-
-    if type(classifier) is list:
-        print("Testing Random Forest classifer")
-        scores = []
-        for i, clf in zip(classes, CV_rfcs):
-            clf.fit(features, labels)
-            score = clf.best_score_
-            best_parameters = clf.best_params_
-            scores.append(score)
-            print('Trained {} score {}'.format(i, score))
-        score = np.mean(scores)
-        print('Done training')
-        
-        if predict:
-            print("Predicting test images")
-            results = []
-            for index, clf in enumerate(CV_rfcs):
-                predictions = clf.predict_proba(test_features)[:, index]
-                results.append(predictions)
-            create_submission(featureType, results, test_images)
-        return score, best_parameters
-    else:
-        print("Testing Logistic Regression classifer")
-        classifier.fit(features, labels)
-        score = CV_log.best_score_
-        best_parameters = CV_log.best_params_
-        if predict:
-            preds = classifier.predict_proba(test_features)
-            create_submission(featureType, preds, test_images)
-        return score, best_parameters
+    cv = folds if folds is not None else get_folds(labels)
+    # folds run in parallel, each one warm starts saga along the C path
+    CV_log = LogisticRegressionCV(Cs=np.logspace(-3, 3, 7), solver="saga",
+                                  multi_class="multinomial", cv=cv, n_jobs=n_jobs,
+                                  max_iter=200)
+
+    print("Testing Logistic Regression classifer")
+    CV_log.fit(features, labels)
+    # multinomial scores are the same for every class, shape (folds, Cs)
+    fold_scores = list(CV_log.scores_.values())[0]
+    score = fold_scores.mean(axis=0).max()
+    best_parameters = {'C': CV_log.C_[0]}
+    if predict:
+        preds = CV_log.predict_proba(test_features)
+        create_submission(featureType, preds, test_images)
+    return score, best_parameters
+
+
+def get_folds(labels):
+    '''
+    Shuffled 10-fold cross validation splits
+    ------------------------------
+    Parameters
+    ----------
+    labels : ndarray
+        1-D array of labels
+
+    Returns
+    -------
+    folds : list
+        (train, test) index arrays for each fold
+    '''
+
+    return list(cross_validation.KFold(n=len(labels), n_folds=10, shuffle=True,
+                                       random_state=0))
+
+
+def scale_features(features, test_features):
+    '''
+    Standardize a feature block with the statistics of the train features
+    ------------------------------
+    Parameters
+    ----------
+    features : ndarray
+        train features
+
+    test_features : ndarray
+        test features
+
+    Returns
+    -------
+    features : ndarray
+        standardized train features
+
+    test_features : ndarray
+        test features standardized with the train mean and variance
+    '''
+
+    scaler = StandardScaler()
+    return scaler.fit_transform(features), scaler.transform(test_features)
 
 
 def print_results(scores):
@@ -171,33 +527,19 @@ def create_submission(featureType, preds, images):
     preds : ndarray
         predicted probabilities for each class
 
-    images : ndarray
-        1-D array of image filepaths
+    images : list
+        (filepath, label) tuples from get_images
 
     '''
 
     print('Creating submission')
-    if(type(preds) is not list):
-        preds = preds.transpose()
-    c0, c1, c2, c3, c4, c5, c6, c7, c8, c9 = preds
-    submission_data = pd.DataFrame({    
-        'img':  [x.split('/')[-1] for x in images],
-        'c0': c0,
-        'c1': c1,
-        'c2': c2,
-        'c3': c3,
-        'c4': c4,
-        'c5': c5,
-        'c6': c6,
-        'c7': c7,
-        'c8': c8,
-        'c9': c9,
-    })
-    
+    names = np.array([os.path.basename(fname) for fname, _ in images])
+    data = np.column_stack([names, preds.astype(str)])
+
     fileName = '{}/{}_submission.csv'.format('submissions', featureType)
-    
-    submission_data[['img', 'c0', 'c1', 'c2', 'c3',
-         'c4', 'c5', 'c6', 'c7', 'c8', 'c9']].to_csv(fileName, index=False)
+
+    np.savetxt(fileName, data, fmt='%s', delimiter=',',
+               header=','.join(['img'] + classes), comments='')
 
 
 def get_images(train):
@@ -211,23 +553,26 @@ def get_images(train):
 
     Returns
     ----------
-    images : iterator
-        iterator of image filepaths
+    images : list
+        (filepath, label) tuples sorted by filepath, label is the class
+        folder for train images and None for test images
 
     '''
 
-    classes = ['c0','c1','c2','c3','c4','c5','c6','c7','c8','c9']
     images = []
-    # Use glob to get all the train_images
+    # Scan each class folder to get all the train_images
     if train:
-        for i in classes:
-            images += glob('{}/{}/{}/*.jpg'.format('imgs', 'train', i))
+        for label in classes:
+            directory = os.path.join('imgs', 'train', label)
+            images += sorted((entry.path, label) for entry in scandir(directory)
+                             if entry.name.endswith('.jpg'))
 
-    # Use glob to get all the test_images
+    # Scan the test folder to get all the test_images
     else:
-        images += glob('{}/{}/*.jpg'.format('imgs', 'test'))
+        directory = os.path.join('imgs', 'test')
+        images += sorted((entry.path, None) for entry in scandir(directory)
+                         if entry.name.endswith('.jpg'))
 
-    images.sort()
     return images
 
 
@@ -252,18 +597,20 @@ def get_kmeans(k, train, descriptors):
         MiniBatchKmeans
     '''
 
-    iterations = 30
     km = get_obj(train, 'k_means')
 
     if km != None:
         return km
     else:    
         start = time.clock()
-        km = MiniBatchKMeans(n_clusters=k, batch_size=1000, n_init=iterations)
+        # a single k-means++ run is enough for a bag of words codebook, larger
+        # batches make better use of BLAS
+        km = MiniBatchKMeans(n_clusters=k, batch_size=4096, n_init=1, max_iter=200,
+                             init='k-means++', reassignment_ratio=0.0, random_state=0)
         print('Clustering with K-means...')
         km.fit(descriptors)
         end = time.clock()
-        print "Time for running %d iterations of K means for %d samples = %f seconds" % (iterations, len(descriptors), end - start)
+        print "Time for running K means for %d samples = %f seconds" % (len(descriptors), end - start)
         # save k_means for later
         print("Saving K-means")
         save_obj(train, 'k_means', km)
@@ -323,10 +670,291 @@ def save_obj(train, objectContent, obj):
         filename = 'objects/test/test_{}.obj'.format(objectContent)
 
     with open(filename, 'wb') as fp:
-        pickle.dump(obj, fp)
+        pickle.dump(obj, fp, protocol=pickle.HIGHEST_PROTOCOL)
         print("Saved %s" % filename)
 
 
+def _image_key(fname):
+    '''
+    Feature cache key of an image, changes when the file is modified
+    ------------------------------
+    Parameters
+    ----------
+    fname : str
+        filepath for image
+
+    Returns
+    ----------
+    key : str
+        hex digest of the absolute path and modification time
+    '''
+
+    ident = '{}:{!r}'.format(os.path.abspath(fname), os.stat(fname).st_mtime)
+    return blake2b(ident.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def _open_cache(filename):
+    '''
+    Open the feature cache, starting a new one when the file cannot be read
+    ------------------------------
+    Parameters
+    ----------
+    filename : str
+        path of the HDF5 cache
+
+    Returns
+    ----------
+    h5py.File
+        cache opened for reading and writing
+    '''
+
+    try:
+        return h5py.File(filename, 'a')
+    except (IOError, OSError):
+        if not os.path.exists(filename):
+            raise
+        # a run killed while writing can leave the file unreadable
+        print('Feature cache {} is corrupt, rebuilding it'.format(filename))
+        os.remove(filename)
+        return h5py.File(filename, 'a')
+
+
+def update_feature_cache(cache, images, keys):
+    '''
+    Extract and store the features of the images missing from the cache
+    ------------------------------
+    Parameters
+    ----------
+    cache : h5py.File
+        feature cache, one group of haralick, lbp and surf datasets per key
+
+    images : list
+        (filepath, label) tuples from get_images
+
+    keys : list
+        cache key of each image
+    '''
+
+    # drop the groups of images that are gone or modified since, and any
+    # temporary group left by a killed run
+    wanted = set(keys)
+    wanted.add(MERGED_GROUP)
+    stale = [key for key in cache if key not in wanted]
+    for key in stale:
+        del cache[key]
+    if stale:
+        print('Removed {} stale groups from the feature cache'.format(len(stale)))
+
+    missing = [(image, key) for image, key in zip(images, keys) if key not in cache]
+    print('Extracting features for {} of {} images'.format(len(missing), len(images)))
+
+    # with a GPU the workers only decode and run surf, the texture features of
+    # every batch go through the single GPU context of this process
+    use_gpu = cupy is not None
+
+    # write each chunk as soon as it is done so an interrupted run keeps its work
+    with Parallel(n_jobs=-1, prefer='processes') as parallel:
+        for start in range(0, len(missing), FEATURE_CACHE_CHUNK):
+            chunk = missing[start:start + FEATURE_CACHE_CHUNK]
+            batches = parallel(
+                delayed(_extract_batch)([image for image, _ in chunk[i:i + HARALICK_BATCH]],
+                                        keep_grey=use_gpu)
+                for i in range(0, len(chunk), HARALICK_BATCH))
+            results = [res for batch in batches for res in batch]
+            if use_gpu:
+                _add_texture_gpu(results)
+
+            for ((fname, _), key), res in zip(chunk, results):
+                # fill a temporary group and move it into place once complete, so a
+                # group under key always has all its datasets. This does not make
+                # HDF5 crash safe, a file damaged by a kill is rebuilt by _open_cache
+                partial = key + '_partial'
+                if partial in cache:
+                    del cache[partial]
+                group = cache.create_group(partial)
+                group['haralick'] = res['haralick']
+                group['lbp'] = res['lbp']
+                group['surf'] = res['surf'].astype(np.float32)
+                cache.move(partial, key)
+                print('Image {}: {}'.format(fname, res['surf'].shape))
+            cache.flush()
+
+
+def _sample_descriptors(cache, keys):
+    '''
+    Random 1/64 of the cached surf descriptors, read without loading the rest
+    ------------------------------
+    Parameters
+    ----------
+    cache : h5py.File
+        feature cache
+
+    keys : list
+        cache key of each image
+
+    Returns
+    ----------
+    ndarray
+        sampled surf descriptors
+    '''
+
+    lengths = np.array([cache[key]['surf'].shape[0] for key in keys])
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    print('Number of descriptors: {}'.format(offsets[-1]))
+
+    # a random sample rather than a fixed stride, the images are sorted by class
+    rng = np.random.RandomState(0)
+    sample = np.sort(rng.choice(offsets[-1], offsets[-1] // 64, replace=False))
+
+    # the sample is sorted, so the rows of image i are sample[bounds[i]:bounds[i + 1]]
+    bounds = np.searchsorted(sample, offsets)
+    descriptors = []
+    for i, key in enumerate(keys):
+        if bounds[i] < bounds[i + 1]:
+            rows = sample[bounds[i]:bounds[i + 1]] - offsets[i]
+            descriptors.append(cache[key]['surf'][rows.tolist()])
+    return np.concatenate(descriptors)
+
+
+def _codebook_digest(km):
+    '''
+    Digest of the k means centres, identifies the codebook a histogram was built with
+    ------------------------------
+    Parameters
+    ----------
+    km : object
+        MiniBatchKmeans
+
+    Returns
+    ----------
+    str
+        hex digest of the cluster centres
+    '''
+
+    centers = np.ascontiguousarray(km.cluster_centers_)
+    return blake2b(centers.tobytes(), digest_size=8).hexdigest()
+
+
+def update_bow_cache(cache, keys, km):
+    '''
+    Store the surf bag of words histogram of the images that do not have one
+    for the current k means codebook yet
+    ------------------------------
+    Parameters
+    ----------
+    cache : h5py.File
+        feature cache, a bow dataset is added to each image group
+
+    keys : list
+        cache key of each image
+
+    km : object
+        MiniBatchKmeans
+    '''
+
+    # histograms built with another codebook are stale
+    codebook = _codebook_digest(km)
+    if cache.attrs.get('codebook') != codebook:
+        for key in cache:
+            if key != MERGED_GROUP and 'bow' in cache[key]:
+                del cache[key]['bow']
+        cache.attrs['codebook'] = codebook
+
+    missing = [key for key in keys if 'bow' not in cache[key]]
+    print('Encoding surf descriptors for {} of {} images'.format(len(missing), len(keys)))
+
+    n_clusters = len(km.cluster_centers_)
+    for start in range(0, len(missing), FEATURE_CACHE_CHUNK):
+        chunk = missing[start:start + FEATURE_CACHE_CHUNK]
+        descriptors = [cache[key]['surf'][()] for key in chunk]
+
+        # assign every descriptor of the chunk in one call, then count the codes per image
+        image_ids = np.repeat(np.arange(len(chunk)), [len(d) for d in descriptors])
+        codes = km.predict(np.concatenate(descriptors))
+        hists = np.bincount(image_ids * n_clusters + codes, minlength=len(chunk) * n_clusters)
+        for key, hist in zip(chunk, hists.reshape(-1, n_clusters).astype(np.float32)):
+            cache[key]['bow'] = hist
+        cache.flush()
+
+
+def _read_merged(cache, keys, codebook):
+    '''
+    Stacked features of the images, read from the merged group in one go
+    ------------------------------
+    Parameters
+    ----------
+    cache : h5py.File
+        feature cache
+
+    keys : list
+        cache key of each image
+
+    codebook : str
+        digest of the current k means codebook
+
+    Returns
+    ----------
+    tuple or None
+        haralick, lbp and bow arrays, None when the merged group was written
+        for another list of images or another codebook
+    '''
+
+    if MERGED_GROUP not in cache:
+        return None
+    merged = cache[MERGED_GROUP]
+    if merged.attrs.get('codebook') != codebook:
+        return None
+    if not np.array_equal(merged['keys'][()], np.array(keys, dtype='S')):
+        return None
+    return merged['haralick'][()], merged['lbp'][()], merged['bow'][()]
+
+
+def _write_merged(cache, keys, km):
+    '''
+    Stack the per image features of keys and store them in the merged group
+    ------------------------------
+    Parameters
+    ----------
+    cache : h5py.File
+        feature cache, every key has haralick, lbp and bow datasets
+
+    keys : list
+        cache key of each image, the row order of the stacked arrays
+
+    km : object
+        MiniBatchKmeans the bow histograms were built with
+
+    Returns
+    ----------
+    tuple
+        haralick, lbp and bow arrays
+    '''
+
+    haralicks = np.empty((len(keys), HARALICK_DIM), dtype=np.float32)
+    lbps = np.empty((len(keys), LBP_DIM), dtype=np.float32)
+    bows = np.empty((len(keys), len(km.cluster_centers_)), dtype=np.float32)
+    for i, key in enumerate(keys):
+        group = cache[key]
+        haralicks[i] = group['haralick'][()]
+        lbps[i] = group['lbp'][()]
+        bows[i] = group['bow'][()]
+
+    # same temporary group and move as the per image groups
+    partial = MERGED_GROUP + '_partial'
+    if partial in cache:
+        del cache[partial]
+    merged = cache.create_group(partial)
+    merged['keys'] = np.array(keys, dtype='S')
+    merged['haralick'] = haralicks
+    merged['lbp'] = lbps
+    merged['bow'] = bows
+    merged.attrs['codebook'] = _codebook_digest(km)
+    if MERGED_GROUP in cache:
+        del cache[MERGED_GROUP]
+    cache.move(partial, MERGED_GROUP)
+    return haralicks, lbps, bows
+
+
 def get_features(train, images):
     ''' 
     Extract features for train or test images
@@ -336,8 +964,8 @@ def get_features(train, images):
     train : Boolean
         if Train, get features for train
 
-    images : ndarray
-        1-D array of image filepaths
+    images : list
+        (filepath, label) tuples from get_images
 
     Returns 
     ----------
@@ -354,97 +982,74 @@ def get_features(train, images):
         1-D flattened array of surf descriptors feature
     '''
 
-    haralicks = []
-    lbps = []
-    labels = []
-    alldescriptors = []
-
     if train:
         k = math.sqrt(22425/2)
-        path = 'objects/train/'
+        filename = 'objects/train/train_features.h5'
     else:
         k = math.sqrt(79727/2)
-        path = 'objects/test/'
+        filename = 'objects/test/test_features.h5'
+
+    # per image features and surf histograms are cached, only new or modified
+    # images are extracted and encoded. The merged group stacks them for the
+    # last list of images, a run over the same images only reads three arrays
+    keys = [_image_key(fname) for fname, _ in images]
+    with _open_cache(filename) as cache:
+        km = get_obj(train, 'k_means')
+        merged = _read_merged(cache, keys, _codebook_digest(km)) if km is not None else None
+        if merged is None:
+            update_feature_cache(cache, images, keys)
+            if km is None:
+                km = get_kmeans(k, train, _sample_descriptors(cache, keys))
+            update_bow_cache(cache, keys, km)
+            merged = _write_merged(cache, keys, km)
+        haralicks, lbps, surf_descriptors = merged
 
-    object_dir_file_num = len([name for name in os.listdir(path) if name.endswith('.obj')])
-
-    if object_dir_file_num == 5:
-        haralicks = get_obj(train, 'haralicks')
-        lbps = get_obj(train, 'lbps')
-        labels = get_obj(train, 'labels')
-        surf_descriptors = get_obj(train, 'surfdescriptors')
+    if train:
+        labels = np.array([label for _, label in images])
     else:
-        for i, fname in enumerate(images):
-            texture = compute_texture(fname)
-            binary_patt = compute_lbp(fname)
-            haralicks.append(texture)
-            lbps.append(binary_patt)
-            if train:
-                label = fname.split('/')[2]
-                labels.append(label)
-            
-            im = mh.imresize(mh.imread(fname, as_grey=True), (600, 450))
-            im = im.astype(np.uint8)
-
-            # Dense sampling of surf 
-            surf_desc = surf.dense(im, spacing=16)
-            # regular surf 
-            # surf.surf(im, descriptor_only=True)
-            print('Image {}: {}'.format(i, surf_desc.shape))
-            alldescriptors.append(surf_desc)
-    
-        concatenated = np.concatenate(alldescriptors)
-        print('Number of descriptors: {}'.format(
-                len(concatenated)))
-        concatenated = concatenated[::64]
-        
-        km = get_kmeans(k, train, concatenated)
-        surf_descriptors = []
-        for d in alldescriptors:
-            c = km.predict(d)
-            surf_descriptors.append(np.bincount(c, minlength=k))
-
-        surf_descriptors = np.array(surf_descriptors, dtype=float)
-        haralicks = np.array(haralicks)
-        lbps = np.array(lbps)
-        labels = np.array(labels)
-
-        save_obj(train, 'surfdescriptors', surf_descriptors)
-        save_obj(train, 'haralicks', haralicks)
-        save_obj(train, 'lbps', lbps)
-        save_obj(train, 'labels', labels)
-
+        labels = np.array([])
 
     return haralicks, lbps, labels, surf_descriptors
 
 
-
-# get images for train and test
-train_images = get_images(True)
-test_images = get_images(False)
-
-# get features for train images
-haralicks, lbps, labels, surf_descriptors = get_features(True, train_images)
-combined = np.hstack([lbps, haralicks])
-combined_all = np.hstack([haralicks, lbps, surf_descriptors])
-
-# get features for test images
-test_haralicks, test_lbps, test_labels, test_surf = get_features(False, test_images)
-test_combined = np.hstack([test_lbps, test_haralicks])
-test_combined_all = np.hstack([test_haralicks, test_lbps, test_surf])
-
-# create classifiers and get the best score and parameters for each possible feature set
-scores_base, params1 = accuracy('base', haralicks, labels, True, test_haralicks, test_images)
-scores_lbps, params2 = accuracy('lbps', lbps, labels, True, test_lbps, test_images)
-scores_surf, params3 = accuracy('surf', surf_descriptors, labels, True, test_surf, test_images)
-scores_combined, params4 = accuracy('combined', combined, labels, True, test_combined, test_images)
-scores_combined_all, params5 = accuracy('combined_all', combined_all, labels, True, test_combined_all, test_images)
-
-# save results in "results_LR.image.txt"
-print_results([
-        ('base', scores_base, params1),
-        ('lbps', scores_lbps, params2),
-        ('surf', scores_surf, params3),
-        ('combined', scores_combined, params4),
-        ('combined_all', scores_combined_all,params5),
-        ])
\ No newline at end of file
+if __name__ == '__main__':
+    # get images for train and test
+    train_images = get_images(True)
+    test_images = get_images(False)
+
+    # get features for train and test images
+    haralicks, lbps, labels, surf_descriptors = get_features(True, train_images)
+    test_haralicks, test_lbps, test_labels, test_surf = get_features(False, test_images)
+
+    # standardize each feature block once, the combined sets reuse the scaled blocks
+    haralicks, test_haralicks = scale_features(haralicks, test_haralicks)
+    lbps, test_lbps = scale_features(lbps, test_lbps)
+    surf_descriptors, test_surf = scale_features(surf_descriptors, test_surf)
+
+    combined = np.hstack([lbps, haralicks])
+    combined_all = np.hstack([haralicks, lbps, surf_descriptors])
+    test_combined = np.hstack([test_lbps, test_haralicks])
+    test_combined_all = np.hstack([test_haralicks, test_lbps, test_surf])
+
+    # every feature set is cross validated on the same folds
+    folds = get_folds(labels)
+
+    feature_sets = [
+            ('base', haralicks, test_haralicks),
+            ('lbps', lbps, test_lbps),
+            ('surf', surf_descriptors, test_surf),
+            ('combined', combined, test_combined),
+            ('combined_all', combined_all, test_combined_all),
+            ]
+
+    # create classifiers and get the best score and parameters for each possible feature set,
+    # one worker per feature set, sharing the cores between their folds
+    fold_jobs = max(1, cpu_count() // len(feature_sets))
+    results = Parallel(n_jobs=len(feature_sets), backend='loky')(
+        delayed(accuracy)(name, features, labels, True, test_features, test_images, folds,
+                          n_jobs=fold_jobs)
+        for name, features, test_features in feature_sets)
+
+    # save results in "results_LR.image.txt"
+    print_results([(name, score, params)
+                   for (name, _, _), (score, params) in zip(feature_sets, results)])
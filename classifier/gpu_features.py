@@ -0,0 +1,146 @@
+import numpy as np
+import cupy
+
+
+_GLCM_KERNEL = cupy.RawKernel(r'''
+extern "C" __global__
+void glcm_kernel(const unsigned char* ims, int* glcms,
+                 const int levels, const int h, const int w)
+{
+    // same direction order as mahotas: (0, 1), (1, 1), (1, 0), (1, -1)
+    const int dys[4] = {0, 1, 1, 1};
+    const int dxs[4] = {1, 1, 0, -1};
+
+    int x = blockIdx.x * blockDim.x + threadIdx.x;
+    int y = blockIdx.y * blockDim.y + threadIdx.y;
+    if (x >= w || y >= h) return;
+
+    const unsigned char* im = ims + (size_t)blockIdx.z * h * w;
+    int* glcm = glcms + (size_t)blockIdx.z * 4 * levels * levels;
+    int a = im[y * w + x];
+
+    for (int d = 0; d < 4; ++d) {
+        int ny = y + dys[d];
+        int nx = x + dxs[d];
+        if (ny >= h || nx < 0 || nx >= w) continue;
+        int b = im[ny * w + nx];
+        // symmetric matrix, every pair is counted in both orders
+        atomicAdd(&glcm[(d * levels + a) * levels + b], 1);
+        atomicAdd(&glcm[(d * levels + b) * levels + a], 1);
+    }
+}
+''', 'glcm_kernel')
+
+
+_LBP_KERNEL = cupy.RawKernel(r'''
+extern "C" __global__
+void lbp_kernel(const float* ims, unsigned int* hists,
+                const float* dys, const float* dxs, const long long* lut,
+                const int points, const int n_bins, const int radius,
+                const int h, const int w)
+{
+    extern __shared__ unsigned int local[];
+    int tid = threadIdx.y * blockDim.x + threadIdx.x;
+    if (tid < n_bins) local[tid] = 0;
+    __syncthreads();
+
+    int x = blockIdx.x * blockDim.x + threadIdx.x;
+    int y = blockIdx.y * blockDim.y + threadIdx.y;
+    if (y >= radius && y < h - radius - 1 && x >= radius && x < w - radius - 1) {
+        const float* im = ims + (size_t)blockIdx.z * h * w;
+        float centre = im[y * w + x];
+        int code = 0;
+        for (int p = 0; p < points; ++p) {
+            float sy = y + dys[p];
+            float sx = x + dxs[p];
+            int y0 = (int)floorf(sy);
+            int x0 = (int)floorf(sx);
+            float fy = sy - y0;
+            float fx = sx - x0;
+            const float* row0 = im + y0 * w + x0;
+            const float* row1 = row0 + w;
+            float top = row0[0] + fx * (row0[1] - row0[0]);
+            float bottom = row1[0] + fx * (row1[1] - row1[0]);
+            if (top + fy * (bottom - top) >= centre) code |= 1 << p;
+        }
+        atomicAdd(&local[lut[code]], 1u);
+    }
+    __syncthreads();
+
+    if (tid < n_bins && local[tid])
+        atomicAdd(&hists[blockIdx.z * n_bins + tid], local[tid]);
+}
+''', 'lbp_kernel')
+
+_BLOCK = (16, 16)
+
+
+def _grid(ims):
+    '''
+    Launch grid covering every pixel of a (N, H, W) stack
+    '''
+    n, h, w = ims.shape
+    return ((w + _BLOCK[0] - 1) // _BLOCK[0], (h + _BLOCK[1] - 1) // _BLOCK[1], n)
+
+
+def glcm_batch(ims_u8, levels):
+    '''
+    Compute the symmetric cooccurence matrices of a stack of images on the GPU
+    ------------------------------
+    Parameters
+    ----------
+    ims_u8 : cupy.ndarray
+        (N, H, W) uint8 grey images
+
+    levels : int
+        number of grey levels, size of each matrix
+    Returns
+    -------
+    cupy.ndarray
+        (N, 4, levels, levels) int32 matrices, one per direction
+    '''
+    ims_u8 = cupy.ascontiguousarray(ims_u8, dtype=cupy.uint8)
+    n, h, w = ims_u8.shape
+    glcms = cupy.zeros((n, 4, levels, levels), dtype=cupy.int32)
+    _GLCM_KERNEL(_grid(ims_u8), _BLOCK,
+                 (ims_u8, glcms, np.int32(levels), np.int32(h), np.int32(w)))
+    return glcms
+
+
+def lbp_batch(ims, dy, dx, lut, n_bins, radius):
+    '''
+    Compute uniform LBP histograms of a stack of images on the GPU
+    ------------------------------
+    Parameters
+    ----------
+    ims : cupy.ndarray
+        (N, H, W) grey images
+
+    dy, dx : ndarray
+        offsets of the sampling points relative to the centre pixel
+
+    lut : ndarray
+        bin index for every LBP code
+
+    n_bins : int
+        number of histogram bins
+
+    radius : int
+        radius of the sampling circle
+    Returns
+    -------
+    cupy.ndarray
+        (N, n_bins) uint32 histograms
+    '''
+    ims = cupy.ascontiguousarray(ims, dtype=cupy.float32)
+    n, h, w = ims.shape
+    hists = cupy.zeros((n, n_bins), dtype=cupy.uint32)
+    _LBP_KERNEL(_grid(ims), _BLOCK,
+                (ims, hists,
+                 cupy.asarray(dy, dtype=cupy.float32),
+                 cupy.asarray(dx, dtype=cupy.float32),
+                 cupy.asarray(lut, dtype=cupy.int64),
+                 np.int32(len(dy)), np.int32(n_bins), np.int32(radius),
+                 np.int32(h), np.int32(w)),
+                shared_mem=n_bins * 4)
+    return hists